@@ -2,13 +2,16 @@ import os
 from flask import Flask, request
 from flask_json import FlaskJSON, JsonError, json_response, as_json
 import requests
-from queue import Queue
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from threading import Event, Lock, Thread
-from time import time
-from datetime import datetime, timedelta
+from uuid import uuid4
+from time import monotonic, time
+from datetime import datetime, timedelta, timezone
 from skyfield.api import Loader, Topos
 from skyfield import almanac
-import numpy as np
 
 
 application = Flask(__name__)
@@ -19,18 +22,27 @@ WEBHOOKS_KEY = os.environ['WEBHOOKS_KEY']
 
 LIGHT_DURATION = 300
 
-def webhooks_trigger(event, value1=None, value2=None, value3=None):
+_session = requests.Session()
+_session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16,
+                                       max_retries=Retry(total=3, backoff_factor=0.2)))
+
+_URL_FMT = f"https://{WEBHOOKS_HOST}/trigger/{{event}}/with/key/{WEBHOOKS_KEY}"
+
+# Single worker so on/off triggers reach IFTTT in submission order
+_trigger_pool = ThreadPoolExecutor(max_workers=1)
+
+def _log_trigger_failure(future):
+    e = future.exception()
+    if e is not None:
+        application.logger.error(f"Webhooks trigger: {repr(e)}")
+
+def webhooks_trigger(event, value1=None, value2=None, value3=None, **extra):
     application.logger.debug(f"Webhooks trigger {event}({value1}, {value2}, {value3})")
-    data = {}
-    if value1 is not None:
-        data['value1'] = value1
-    if value2 is not None:
-        data['value2'] = value2
-    if value3 is not None:
-        data['value3'] = value3
-    if len(data):
-        data=None
-    r = requests.get(f"https://{WEBHOOKS_HOST}/trigger/{event}/with/key/{WEBHOOKS_KEY}", json=data)
+    data = {k: v for k, v in (('value1', value1), ('value2', value2), ('value3', value3))
+            if v is not None} or None
+    if extra:
+        data = {**(data or {}), **extra}
+    r = _session.get(_URL_FMT.format(event=event), json=data, timeout=5.0)
     r.raise_for_status()
 
 @application.route("/")
@@ -47,20 +59,32 @@ class Lights:
     
     @property
     def on(self):
-        with self._lock:
-            return self._on
+        # Plain bool read; only the scheduler thread writes _on
+        return self._on
 
     @on.setter
     def on(self, on):
+        event = None
         with self._lock:
-            if on and not self._on:
-                self._on = True
-                webhooks_trigger('outdoor_lights_on')
-            elif not on and self._on:
-                self._on = False
-                webhooks_trigger('outdoor_lights_off')
+            if on != self._on:
+                self._on = on
+                event = 'outdoor_lights_on' if on else 'outdoor_lights_off'
+        if event is not None:
+            _trigger_pool.submit(webhooks_trigger, event).add_done_callback(_log_trigger_failure)
     
 
+@lru_cache(maxsize=None)
+def _skyfield_loader():
+    return Loader('skyfield-data')
+
+@lru_cache(maxsize=None)
+def _timescale():
+    return _skyfield_loader().timescale()
+
+@lru_cache(maxsize=None)
+def _planets():
+    return _skyfield_loader()('de421.bsp')
+
 class Sun:
     """
     >>> sun = Sun(('59.499505 N', '18.085150 E'))
@@ -76,15 +100,31 @@ class Sun:
     >>> up = sun.up
     """
     def __init__(self, location):
-        load = Loader('skyfield-data')
-        self._ts = load.timescale()
-        planets = load('de421.bsp')
-        loc = Topos(*location)
-        self._sun_up = almanac.sunrise_sunset(planets, loc)
+        self._ts = _timescale()
+        self._sun_up = almanac.sunrise_sunset(_planets(), Topos(*location))
+        self._currently_up = None
+        self._next_transition = None
 
     @property
     def up(self):
-        return self._sun_up(self._ts.now())
+        if self._next_transition is None or datetime.now(timezone.utc) >= self._next_transition:
+            self._refresh()
+        return self._currently_up
+
+    @property
+    def next_transition(self):
+        return self._next_transition
+
+    def _refresh(self):
+        t0 = self._ts.now()
+        t1 = self._ts.tt_jd(t0.tt + 2)
+        times, events = almanac.find_discrete(t0, t1, self._sun_up)
+        self._currently_up = bool(self._sun_up(t0))
+        if len(times):
+            self._next_transition = times[0].utc_datetime()
+        else:
+            # No transition within 48 h (polar day/night); check back later
+            self._next_transition = datetime.now(timezone.utc) + timedelta(hours=6)
 
 class TimeSlot:
     """ Defines a time slot 
@@ -125,14 +165,22 @@ class TimeSlot:
     >>> active = awake.active
     """
     def __init__(self, start, stop, weekdays=None):
-        self._range = np.array([datetime.strptime(t, "%H:%M") for t in [start, stop]])
-        self._weekdays = weekdays
+        self._start_s, self._stop_s = (t.hour * 3600 + t.minute * 60
+                                       for t in (datetime.strptime(t, "%H:%M") for t in [start, stop]))
+        self._weekday_mask = 0x7F if weekdays is None else sum(1 << d for d in weekdays)
 
     def within(self, x):
-        if self._weekdays is not None and x.weekday() not in self._weekdays:
+        if not (self._weekday_mask >> x.weekday()) & 1:
             return False
-        until_next = self._range - x - timedelta(microseconds=1)
-        return until_next[0].seconds > until_next[1].seconds
+        s = x.hour * 3600 + x.minute * 60 + x.second
+        if self._start_s <= self._stop_s:
+            return self._start_s <= s < self._stop_s
+        return s >= self._start_s or s < self._stop_s
+
+    def next_boundary(self, x):
+        """ Seconds until the next start or stop boundary after x """
+        s = x.hour * 3600 + x.minute * 60 + x.second
+        return min((b - s) % 86400 or 86400 for b in (self._start_s, self._stop_s))
 
     @property
     def active(self):
@@ -152,33 +200,43 @@ class Scheduler(Thread):
         while True:
             try:
                 self._loop()
-                self._dirty.wait(1.0)
+                self._dirty.wait(self._seconds_to_next_event())
                 self._dirty.clear()
             except BaseException as e:
                 application.logger.error(f"Scheduler: {repr(e)}")
 
+    def _seconds_to_next_event(self):
+        now = datetime.utcnow()
+        wait = min((slot.next_boundary(now) for slot in self._on_slots), default=3600.0)
+        transition = self._sun.next_transition
+        if transition is not None:
+            wait = min(wait, (transition - datetime.now(timezone.utc)).total_seconds())
+        if self._greet_until is not None:
+            wait = min(wait, self._greet_until - monotonic())
+        return max(0.5, wait)
+
     def _loop(self):
-        on = False
-        for on_slot in self._on_slots:
-            if on_slot.active:
-                application.logger.debug(f"on slot active")
-                on = True
-        if self._greet_until is not None and datetime.utcnow() < self._greet_until:
-            application.logger.debug(f"{datetime.utcnow()} < {self._greet_until}")
-            on = True
+        if self._greet_until is not None and monotonic() >= self._greet_until:
+            self._greet_until = None
         if self._sun.up:
             application.logger.debug(f"Sun up")
-            on = False
+            self._lights.on = False
+            return
+        now = datetime.utcnow()
+        on = any(on_slot.within(now) for on_slot in self._on_slots)
+        if not on and self._greet_until is not None and monotonic() < self._greet_until:
+            application.logger.debug(f"greeting until {self._greet_until}")
+            on = True
         self._lights.on = on
 
 
     def greet(self, duration: timedelta):
-        self._greet_until = datetime.utcnow() + duration
+        self._greet_until = monotonic() + duration.total_seconds()
         self._dirty.set()
 
 
 LOCATION = os.environ['LOCATION'].split(':')
-scheduler = Scheduler(Sun(LOCATION), {TimeSlot('05:00', '22:00')})
+scheduler = Scheduler(Sun(LOCATION), (TimeSlot('05:00', '22:00'),))
 scheduler.start()
 
 @application.route("/webhooks/arlo/<event>/<device>")
@@ -187,19 +245,43 @@ def webhooks_arlo(event, device):
     return ""
 
 
-loopback_complete = Queue()
+_loopback_lock = Lock()
+_loopback_pending = {}
+
 @application.route("/trigger_loopback")
 @as_json
 def trigger_loopback():
     application.logger.info(f"trigger_loopback: {request}:{request.args}")
     start = time()
-    webhooks_trigger('loopback', **{f'value{i}': request.args.get(f'value{i}', i) for i in [1, 2, 3]})
-    response = loopback_complete.get(timeout=10.0)
+    cid = uuid4().hex
+    done = Event()
+    slot = []
+    with _loopback_lock:
+        _loopback_pending[cid] = (done, slot)
+    try:
+        webhooks_trigger('loopback', cid=cid,
+                         **{f'value{i}': request.args.get(f'value{i}', i) for i in [1, 2, 3]})
+        if not done.wait(10.0):
+            raise JsonError(description='loopback timed out')
+    finally:
+        with _loopback_lock:
+            _loopback_pending.pop(cid, None)
+    response = slot[0]
     response['round trip'] = time() - start
     return response
 
 @application.route("/loopback")
 def loopback():
     application.logger.info(f"loopback: {request.json}")
-    loopback_complete.put(request.json)
+    cid = (request.json or {}).get('cid')
+    with _loopback_lock:
+        if cid in _loopback_pending:
+            done, slot = _loopback_pending.pop(cid)
+        elif _loopback_pending:
+            # Applet did not echo the cid; deliver to the oldest waiter
+            done, slot = _loopback_pending.pop(next(iter(_loopback_pending)))
+        else:
+            return ""
+    slot.append(request.json)
+    done.set()
     return ""